@@ -1,21 +1,34 @@
 #!/usr/bin/env python3
 
 # General python libraries used
-import math
 import os
 import argparse
+import collections
 import csv
-from sys import getsizeof
+import functools
+import io
+import logging
+import pathlib
+import sys
+from typing import Optional
+from concurrent.futures import FIRST_COMPLETED, ThreadPoolExecutor, wait
+
+# NumPy is used to work with the pixel values of the images directly
+import numpy as np
+
+# OpenCV is used to resize the tiles read from the slides
+import cv2
 
 # In order to parse SVS images, we will need to use the OpenSlide library
 import openslide
 
 # Pillow (PIL) is being used for the image conversion
-# (NOTE) you could install Pillow-SIMD instead of Pillow (see requirements file) for faster processing
+# (NOTE) on x86-64 you could install Pillow-SIMD instead of Pillow for faster processing (see the README)
 import PIL
 
 # This is the clarifai gRPC client
 # This is being used to push the tranlated images to Clarifai.com
+import grpc
 from clarifai_grpc.channel.clarifai_channel import ClarifaiChannel
 from clarifai_grpc.grpc.api import service_pb2_grpc
 from clarifai_grpc.grpc.api import service_pb2, resources_pb2
@@ -26,40 +39,144 @@ from google.protobuf.struct_pb2 import Struct
 
 
 # Global Variables
+# Logger for this script.  Most messages are only at the debug level, so they cost nothing unless -v is given.
+logger = logging.getLogger(__name__)
 # Create the communication stub here for the Clarifai Client
 stub = service_pb2_grpc.V2Stub(ClarifaiChannel.get_grpc_channel())
 # Scale factor to decrease the image size - this will decrease the size by dividing height and width by this amount
-#       This reduces the image size so the Clarifai system will accept it (25 Mb limit at the current time).
-# We need to do this because the images are very large
-SCALE_FACTOR = 25
+# We need to do this because the images are very large.  This is only the starting point: if the JPEG encoded image
+# is still too large for the Clarifai system to accept, it is shrunk further (see `encode_image`).
+SCALE_FACTOR = 8
+# Size (in pixels, at the level being read) of the square regions the slide is read in.  Reading the slide a piece
+# at a time keeps the memory use small, instead of needing enough memory to hold the whole slide at once.
+TILE_SIZE = 4096
+# Largest number of threads used to read and resize the tiles of a slide.  Each thread holds a full size tile (and a
+# copy of its pixel values) in memory, roughly 130 Mb at the default TILE_SIZE, so this keeps the memory use bounded
+# on machines with many CPUs.
+MAX_TILE_WORKERS = 8
+# Quality (out of 100) of the JPEG encoding used to send the scaled images to Clarifai.
+JPEG_QUALITY = 85
+# Largest size (in bytes) of an encoded image.  This keeps the images under the size the Clarifai system will accept
+# (25 Mb limit at the current time), with some room to spare for the rest of the request.
+MAX_IMAGE_BYTES = 22_000_000
+# Each time an encoded image is too large, its height and width are divided by this amount before trying again.
+SHRINK_FACTOR = 1.2
+# Number of images sent to Clarifai in each call.  Sending several images together saves paying the cost of a
+# round trip to the server for each one.
+BATCH_SIZE = 32
+# Largest total size (in bytes) of the inputs sent to Clarifai in each call.  A batch is sent early if adding the next
+# input would take it over this size.  The 25 Mb limit is treated as applying to the whole request (not just to each
+# image), so each batch is kept under it; a single image (at most MAX_IMAGE_BYTES) always fits on its own.
+MAX_BATCH_BYTES = 24_000_000
+# Number of batches that can be on their way to Clarifai at the same time.  The next slides are scaled while the
+# earlier batches are being sent, rather than waiting for each call to finish before carrying on.
+MAX_IN_FLIGHT = 8
 
 # Helper functions - this is used to encapsulate code so it is easier to read / maintain
-def get_project(match):
+@functools.lru_cache(maxsize=None)
+def load_project_index() -> dict:
+    '''
+    Reads the known CSV metadata file once and returns a dictionary of its rows, keyed by the TCGA ID (the ninth
+    column).  The result is cached, so the file is only read the first time this is called, and every lookup after
+    that is a single dictionary access rather than a scan through the whole file.  If an ID appears more than once,
+    the first row for it is kept.
+    '''
+    project_index = {}
+    with open("tcga_metadata.csv", "r") as f:
+        csvreader = csv.reader(f, delimiter=",")
+        for row in csvreader:
+            project_index.setdefault(row[8], (row[1], row[3], row[4], row[7]))
+    return project_index
+
+
+@functools.lru_cache(maxsize=None)
+def get_project(match: str) -> Optional[dict]:
     '''
     Helper function which extracts out metadata from a known CSV object and returns it.  This is custom for the
     specific CSV that was conveniently available.
 
     This should be thought of as custom and would likely need to be changed to meet your requirements.
 
-    Returns a dictionary with four different metadata values in it.
+    Returns a dictionary with four different metadata values in it.  The result is cached for each ID, so the same
+    dictionary is returned every time an ID is looked up - it should not be changed by the caller.
     '''
-    with open("tcga_metadata.csv", "r") as f:
-        csvreader = csv.reader(f, delimiter=",")
-        for row in csvreader:
-            if row[8] == match:
-                return {"primary_site": row[1], "project_disease_type": row[3], "project_name": row[4], "tcga_cancer_type": row[7]}
-    return None
+    project = load_project_index().get(match)
+    if project is None:
+        return None
+    return {"primary_site": project[0], "project_disease_type": project[1], "project_name": project[2], "tcga_cancer_type": project[3]}
 
 
-def send_image(img_location, meta_data, metadata):
+def get_tile_size(slide, level):
     """
-    Sends an image and its metadata to the Clarifai App that was set up (and the key was provided).  This is fairly
-    custom for this particular project, but could be adapted to work with other types of projects.
+    Returns the size of the square tiles to read a level of the slide in.  This is TILE_SIZE, rounded down to a
+    multiple of the tile width the slide is stored with when the slide records it.
     """
+    stored_tile_w = int(slide.properties.get("openslide.level[{}].tile-width".format(level), 0))
+    if stored_tile_w <= 0 or stored_tile_w >= TILE_SIZE:
+        return max(stored_tile_w, TILE_SIZE)
+    return TILE_SIZE // stored_tile_w * stored_tile_w
 
-    # Opens the PNG image location passed in.
-    with open(img_location, "rb") as f:
-        file_bytes = f.read()
+
+def read_scaled_tile(slide, level, tile_box, new_box):
+    """
+    Reads one tile of a level of the slide and resizes it down to the area it covers in the new image.
+
+    `tile_box` is the (x, y, width, height) of the tile in the coordinates of the level, and `new_box` is the
+    (x, y, width, height) it covers in the new image.  Returns the position in the new image and the resized tile.
+    """
+    tile_x, tile_y, tile_w, tile_h = tile_box
+    new_x, new_y, new_w, new_h = new_box
+    downsample = slide.level_downsamples[level]
+
+    # Just reading the tile into a new object.  This is provided by the OpenSlide library and is based
+    # on their API.  It it not necessarily code that you would 'just know' without consulting how
+    # to use the library!  Note that the location is always given in level 0 coordinates, while the size
+    # is given in the coordinates of the level being read.
+    tile = slide.read_region((int(tile_x * downsample), int(tile_y * downsample)), level, (tile_w, tile_h))
+
+    # Here is the actual resizing of the tile, down to the area it covers in the new image.  The level we read has
+    # already been downsampled by `downsample`, so this only covers the remaining factor.  The resizing is done by
+    # OpenCV using 'area' interpolation, which averages all of the pixels each new pixel covers - this gives better
+    # results than bilinear interpolation when shrinking an image by a large amount, and is very fast.  OpenCV works
+    # on NumPy arrays, so we take the pixel values out of the PIL image first.  You can just think of this as a
+    # vector or matrix of all of the pixel values of the image.
+    rgba = cv2.resize(np.asarray(tile), (new_w, new_h), interpolation=cv2.INTER_AREA)
+
+    # Here we want to convert the tile from RGBA (red-green-blue-alpha), which is what OpenSlide gives us, to RGB
+    # (red-green-blue) format.  The Clarifai platform can understand several different formats, but RGB is a common
+    # one most images you're used to are in.  The alpha (transparency) channel of a slide is always fully opaque, so
+    # we simply drop it by taking the first three channels of the pixel values, in a single copy.
+    return new_x, new_y, PIL.Image.fromarray(np.ascontiguousarray(rgba[:, :, :3]), "RGB")
+
+
+def encode_image(img):
+    """
+    Encodes the PIL image as a JPEG in memory, rather than saving it to the disk and reading it back in.  JPEG is much
+    smaller than PNG for these images (slides are mostly smooth areas of colour), so the image can be sent at a much
+    higher resolution than before.  If the encoded image is larger than MAX_IMAGE_BYTES, the image is shrunk by
+    SHRINK_FACTOR and encoded again until it fits.
+
+    Returns the JPEG encoded bytes.
+    """
+    while True:
+        buf = io.BytesIO()
+        img.save(buf, format="JPEG", quality=JPEG_QUALITY)
+        if buf.tell() <= MAX_IMAGE_BYTES:
+            return buf.getvalue()
+
+        new_w, new_h = max(1, int(img.width / SHRINK_FACTOR)), max(1, int(img.height / SHRINK_FACTOR))
+        logger.debug("Encoded image is %d bytes, shrinking to %dx%d", buf.tell(), new_w, new_h)
+        img = img.resize((new_w, new_h), PIL.Image.BILINEAR)
+
+
+def build_input(img, meta_data):
+    """
+    Builds the Clarifai input for an image and its metadata, ready to be sent to the Clarifai App that was set up
+    (see `send_inputs`).  This is fairly custom for this particular project, but could be adapted to work with other
+    types of projects.
+    """
+
+    file_bytes = encode_image(img)
     
     #
     # The following set of code generating the metadata to be sent with the API call is somewhat complex.  It is
@@ -70,65 +187,141 @@ def send_image(img_location, meta_data, metadata):
     input_metadata = Struct()
     input_metadata.update(meta_data)
 
-    concepts = [resources_pb2.Concept(id=meta_data["general_cancer"], value=1.)]
     project = get_project(meta_data["tcga_id"])
 
-    # This following if statement simply formats the metadata in the way that is desired.  While it looks complex,
-    # that is fundementally all that is happening.  The `concepts.append(...)` function is adding each entry of 
-    # metadata/    
+    # This following code simply formats the metadata in the way that is desired.  While it looks complex, that is
+    # fundementally all that is happening.  Each of the three metadata fields can hold several entries (separated by
+    # ';'), and each entry of all three fields is added as a concept - shortened to the first 31 characters, with
+    # spaces replaced by underscores - after the general cancer type.  All of the entries are known up front, so the
+    # list of concepts is built in one go.
+    parts = []
     if project is not None:
-        primary_sites = project["primary_site"].split(";")
-        for primary_site in primary_sites:
-            primary_site = (primary_site[:31]) if len(primary_site) > 31 else primary_site
-            concepts.append(resources_pb2.Concept(id=primary_site.replace(" ", "_"), value=1.))
-        project_names = project["project_name"].split(";")
-        for project_name in project_names:
-            project_name = (project_name[:31]) if len(project_name) > 31 else project_name
-            concepts.append(resources_pb2.Concept(id=project_name.replace(" ", "_"), value=1.))
-        tcga_cancer_types = project["tcga_cancer_type"].split(";")
-        for tcga_cancer_type in tcga_cancer_types:
-            tcga_cancer_type = (tcga_cancer_type[:31]) if len(tcga_cancer_type) > 31 else tcga_cancer_type
-
-            concepts.append(resources_pb2.Concept(id=tcga_cancer_type.replace(" ", "_"), value=1.))
+        fields = (project["primary_site"], project["project_name"], project["tcga_cancer_type"])
+        parts = [part for field in fields for part in field.split(";")]
+    concepts = [resources_pb2.Concept(id=meta_data["general_cancer"], value=1.)] + \
+               [resources_pb2.Concept(id=part[:31].replace(" ", "_"), value=1.) for part in parts]
 
+    #
+    # This is the input as the Clarifai API expects it.  The image bytes just need to be put where `base64=` is at and
+    # the concepts are included in the `concepts=` line (the concepts we generated earlier).  We are also adding the
+    # raw input metadata we contained in the `metadata=` line.
+    #
+    return resources_pb2.Input(
+        data=resources_pb2.Data(
+            image=resources_pb2.Image(
+                base64=file_bytes
+            ),
+            concepts=concepts,
+            metadata=input_metadata
+        )
+    )
+
+
+def send_inputs(inputs, metadata):
+    """
+    Starts sending a batch of inputs (see `build_input`) to the Clarifai App that was set up (and the key was
+    provided) in a single call.  This returns straight away with a future for the response; pass it on to
+    `finish_send` to wait for the call to finish.
+    """
     #
     # Call to the Clarifai API.
     # This looks complicated, but this is really almost all boilerplate.  In reality this is just a gRPC call (another
     # commonly used Google library for communication across ports).  In order to understand what is going on here
-    # would require a deeper understanding of gRPC works.  However, for these purposes, the image bypes just needs
-    # to be put where `base64=` is at and the concepts are included in the `conceps=` line (the concepts we generated 
-    # earlier).  We are also adding the raw input metadata we contained in the optional (first) `metadata=` line.
-    # Finally, the final `metadata=` line is actually the App access metadata (the API Key from Clarifai) to prove
-    # that we have the credentials to access the App.
+    # would require a deeper understanding of gRPC works.  However, for these purposes, all of the inputs in the batch
+    # are sent together in the `inputs=` line.  The `metadata=` line is actually the App access metadata (the API Key
+    # from Clarifai) to prove that we have the credentials to access the App.  Calling `.future(...)` rather than
+    # calling the method directly lets the call carry on in the background, over the same connection as every other
+    # call made with the stub.
     #
-    post_inputs_response = stub.PostInputs(
+    return stub.PostInputs.future(
         service_pb2.PostInputsRequest(
-            inputs=[
-                resources_pb2.Input(
-                    data=resources_pb2.Data(
-                        image=resources_pb2.Image(
-                            base64=file_bytes
-                        ),
-                        concepts=concepts,
-                        metadata=input_metadata
-                    )
-                )
-            ]
+            inputs=inputs
         ),
         metadata=metadata
     )
-    
+
+
+def finish_send(post_inputs_future, slide_paths):
+    """
+    Waits for a call started by `send_inputs` to finish.  `slide_paths` are the SVS files the inputs were made from,
+    which are removed once the inputs have been sent successfully.
+
+    Returns True if the inputs were sent successfully, and False (after logging the error) if they were not.  Failures
+    are not raised here, so that the caller can still finish the other batches that are on their way.
+    """
+    try:
+        post_inputs_response = post_inputs_future.result()
+    except grpc.RpcError as e:
+        logger.error("Post inputs failed for %s: %s", slide_paths, e)
+        return False
+
     #
-    # Finally we just check for any type of error and clean up the SVS file to save space.  The removal of the SVS
-    # file could be removed if you were going to use them for another purpose.
+    # Finally we just check for any type of error and clean up the SVS files to save space.  The removal of the SVS
+    # files could be removed if you were going to use them for another purpose.
     #
     if post_inputs_response.status.code != status_code_pb2.SUCCESS:
-        print("-- Failed Response: {}".format(post_inputs_response))
-        raise Exception("Post inputs failed, status: " + post_inputs_response.status.details)
-    else:
-        os.remove(img_location)
-        svs_img = os.path.splitext(img_location)[0] + '.svs'
-        os.remove(svs_img)
+        logger.error("Failed Response for %s: %s", slide_paths, post_inputs_response)
+        return False
+
+    # The inputs were sent, so this counts as a success even if an SVS file cannot be removed (it is only logged) -
+    # otherwise the batches still waiting to finish would never be cleaned up.
+    for slide_path in slide_paths:
+        try:
+            os.remove(slide_path)
+        except OSError as e:
+            logger.warning("Could not remove sent slide %s: %s", slide_path, e)
+    return True
+
+
+def find_slides(paths):
+    """
+    Expands a list of SVS file paths and directories into a list of SVS file paths.  Directories are searched
+    (including their subdirectories) for files ending in '.svs', and '-' is replaced by the paths read from stdin
+    (one per line).  Each slide is only listed once (in the order it was first found), even if it was given more than
+    once, so that it is not scaled and sent twice.
+    """
+    slide_paths = []
+    for path in paths:
+        if path == "-":
+            slide_paths.extend(find_slides(line.strip() for line in sys.stdin if line.strip()))
+        elif os.path.isdir(path):
+            for dirpath, dirnames, filenames in os.walk(path):
+                dirnames.sort()
+                slide_paths.extend(os.path.join(dirpath, filename) for filename in sorted(filenames)
+                                   if filename.lower().endswith(".svs"))
+        else:
+            slide_paths.append(path)
+    return list(dict.fromkeys(os.path.normpath(slide_path) for slide_path in slide_paths))
+
+
+def get_sample_metadata(slide_path):
+    """
+    Construct the metadata including the cancer type, and the GDC ID, etc.
+    This could really include whatever information is relevant to label the
+    images with.
+
+    In this particular case, we are just taking advantage of the fact that this
+    information is contained in the paths downloaded, and parsing from there.
+    A more robust implementation would query the metadata of an item based on
+    the GDC ID or some other information extracted from the file name.
+
+    The path is expected to end in '<general cancer>/<GDC ID>/<TCGA ID>.<...>.svs'.  The path is split into its
+    parts once (using pathlib, so that this works with Windows paths as well) and the metadata is taken from there.
+    Returns None if the path is too short to follow that layout.
+    """
+    parts = pathlib.PurePath(slide_path).parts
+    if len(parts) < 3:
+        logger.warning("Slide path does not match '<general cancer>/<GDC ID>/<file>.svs', skipping : %s", slide_path)
+        return None
+    *_, general_cancer, gdc_id, file_name = parts
+    tcga_full_id = file_name.split(".", 1)[0]
+
+    return {
+        "general_cancer": general_cancer,
+        "gdc_id": gdc_id,
+        "tcga_full_id": tcga_full_id,
+        "tcga_id": "-".join(tcga_full_id.split("-")[:3])
+    }
 
 
 def slide_to_scaled_pil_image(slide_path, meta_data):
@@ -136,98 +329,181 @@ def slide_to_scaled_pil_image(slide_path, meta_data):
     Convert a WSI training slide to a scaled-down PIL image.
 
     Returns:
-        Tuple consisting of scaled-down PIL image, original width, original height, new width, and new height.
+        The scaled-down PIL image, or None if the slide could not be opened.
     """
-    # Various print statements are used in place of logging with the Python logging module.
-    # This is just for convenience, in a more robust script the logging module should be used.
-    print("[ info ] Opening Slide : %s" % slide_path)
+    logger.debug("Opening Slide : %s", slide_path)
 
-    # Attempt to open the slide using OpenSlide (based on the OpenSlide documentation)
+    # Attempt to open the slide using OpenSlide (based on the OpenSlide documentation).  Files OpenSlide does not
+    # recognise are handed on to PIL, which raises an OSError for files it cannot read either (as do missing files
+    # and files we do not have permission to read).
     try:
         slide = openslide.open_slide(slide_path)
-    except openslide.OpenSlideError:
-        slide = None
-    except FileNotFoundError:
+    except (openslide.OpenSlideError, OSError):
         slide = None
 
+    # If the slide could not be opened there is nothing to scale, so we give up on it here (rather than crashing)
+    # and let the caller carry on with the next slide.
+    if slide is None:
+        logger.warning("Could not open slide, skipping : %s", slide_path)
+        return None
+
     # This is just the math to scale the image.  Essentially we need to take the height and the width
-    # of a rectangle, and just divide by our scale factor.
+    # of a rectangle, and just divide (rounding down) by our scale factor.
     large_w, large_h = slide.dimensions
-    new_w = math.floor(large_w / SCALE_FACTOR)
-    new_h = math.floor(large_h / SCALE_FACTOR)
+    new_w = large_w // SCALE_FACTOR
+    new_h = large_h // SCALE_FACTOR
+
+    # SVS files are stored as a pyramid: the base level 0 is the full resolution image, and the levels above it
+    # are precomputed, downsampled copies of it.  Rather than reading the (very large) level 0 and shrinking it
+    # by SCALE_FACTOR, we ask OpenSlide for the level closest to (but not smaller than) our target size.  This
+    # reads far fewer pixels from the disk, and only leaves a small amount of resizing left for us to do.
+    level = slide.get_best_level_for_downsample(SCALE_FACTOR)
+
+    level_w, level_h = slide.level_dimensions[level]
+
+    # If the level is small enough to be read in a single tile, OpenSlide can do all of the work for us: its
+    # `get_thumbnail` function picks the pyramid level itself, reads it in one go, and shrinks it down (already in RGB
+    # format).  It always reads the whole level at once though, so larger levels are read a tile at a time below.
+    tile_size = get_tile_size(slide, level)
+    if level_w <= tile_size and level_h <= tile_size:
+        return slide.get_thumbnail((new_w, new_h))
+
+    # Rather than reading the whole level into memory at once (which can be many gigabytes), we read it a tile at a
+    # time.  Each tile is resized down to the small area it covers in the final image and pasted in to place, so
+    # only a few full size tiles need to be held in memory at any point.  The tile size is rounded to a multiple of
+    # the tile size the SVS file is stored with (if it is recorded), so each read lines up with the stored tiles.
+    img = PIL.Image.new("RGB", (new_w, new_h))
+
+    # Each tile can be read and resized independently of the others, so the tiles are spread across threads (one
+    # per CPU, up to MAX_TILE_WORKERS).  Threads are enough here, since OpenSlide's decoding and OpenCV's resizing
+    # both happen outside of Python (and release the GIL while they run).  OpenCV would otherwise use its own threads
+    # for each resize as well, so it is limited to one thread (this setting is global to OpenCV) to avoid running
+    # more threads than there are CPUs.  The resized tiles are pasted in as they finish.
+    with ThreadPoolExecutor(max_workers=min(os.cpu_count() or 1, MAX_TILE_WORKERS),
+                            initializer=cv2.setNumThreads, initargs=(1,)) as executor:
+        futures = set()
+        for tile_y in range(0, level_h, tile_size):
+            for tile_x in range(0, level_w, tile_size):
+                # The area this tile covers in the new image.  Working out both edges from the level coordinates
+                # (rather than the tile size) means that neighbouring tiles always meet exactly, without gaps or
+                # overlaps.
+                new_x0, new_x1 = tile_x * new_w // level_w, min(tile_x + tile_size, level_w) * new_w // level_w
+                new_y0, new_y1 = tile_y * new_h // level_h, min(tile_y + tile_size, level_h) * new_h // level_h
+                if new_x1 == new_x0 or new_y1 == new_y0:
+                    continue
+
+                tile_w, tile_h = min(tile_size, level_w - tile_x), min(tile_size, level_h - tile_y)
+                futures.add(executor.submit(
+                    read_scaled_tile, slide, level, (tile_x, tile_y, tile_w, tile_h),
+                    (new_x0, new_y0, new_x1 - new_x0, new_y1 - new_y0)
+                ))
+
+        # Finished tiles are taken out of `futures` as they are pasted in, so the resized tiles are not all kept in
+        # memory alongside the new image until the end.
+        while futures:
+            done, futures = wait(futures, return_when=FIRST_COMPLETED)
+            for future in done:
+                new_x0, new_y0, tile = future.result()
+                img.paste(tile, (new_x0, new_y0))
+
+    # We will now return the PIL image itself, so it can be sent in the next step without being saved to the disk
+    # and opened up again.
+    return img
+
+
+def build_batches(slide_paths):
+    """
+    Scales each of the slides (see `slide_to_scaled_pil_image`) and groups their inputs (see `build_input`) into
+    batches of BATCH_SIZE, or fewer if the batch would be larger than MAX_BATCH_BYTES.  Slides that cannot be opened
+    (or whose path the metadata cannot be taken from) are skipped, and left in place.
 
-    # In the data that we are using, the base level 0 is what we want.  In SVS data there can be
-    # a number of other levels having other information, such as thumbnail information or overlayes
-    # for the image.  In order to know what to do here you will need to know your data!
-    level = 0  #slide.get_best_level_for_downsample(SCALE_FACTOR)
+    Yields a list of inputs and the list of SVS files they were made from for each batch.
+    """
+    inputs = []
+    batch_slide_paths = []
+    batch_bytes = 0
+    for slide_path in find_slides(slide_paths):
+        sample_metadata = get_sample_metadata(slide_path)
+        if sample_metadata is None:
+            continue
+        img = slide_to_scaled_pil_image(slide_path, sample_metadata)
+        if img is None:
+            continue
+        clarifai_input = build_input(img, sample_metadata)
+        input_bytes = clarifai_input.ByteSize()
+
+        if inputs and batch_bytes + input_bytes > MAX_BATCH_BYTES:
+            yield inputs, batch_slide_paths
+            inputs, batch_slide_paths, batch_bytes = [], [], 0
+
+        inputs.append(clarifai_input)
+        batch_slide_paths.append(slide_path)
+        batch_bytes += input_bytes
+
+        if len(inputs) == BATCH_SIZE:
+            yield inputs, batch_slide_paths
+            inputs, batch_slide_paths, batch_bytes = [], [], 0
+
+    if inputs:
+        yield inputs, batch_slide_paths
+
+
+def main(slide_paths, metadata):
+    """
+    Scales each of the slides and sends them to the Clarifai App that was set up (and the key was provided).  All of
+    the slides share the same connection to Clarifai, so the cost of setting it up is only paid once.
 
-    # Just reading level 0 into a new object.  This is provided by the OpenSlide library and is based
-    # on their API.  It it not necessarily code that you would 'just know' without consulting how
-    # to use the library!
-    whole_slide_image = slide.read_region((0, 0), level, slide.level_dimensions[level])
-
-    # Here we want to convert the image from whatever format it is in internally to RGB (red-green-blue) format.
-    # The Clarifai platform can understand several different formats, but RGB is a common one most images you're 
-    # used to are in.
-    whole_slide_image = whole_slide_image.convert("RGB")
-
-    # Here is the actual resizing of the image.  Note that we are resizing not the original, but the copy that
-    # we've made in memory.  Once again, this is a function provided by the OpenSlide API and how to use this
-    # is provided through their API instructions.  We are taking advantage of a typical object type in python,
-    # a PIL image - while this is not a built in type it is common to use in data science.  Fundementally this
-    # is just a NumPy array (something also not built into Python).  You can just think of this as a vector or 
-    # matrix of all of the pixel values of the image.
-    img = whole_slide_image.resize((new_w, new_h), PIL.Image.BILINEAR)
-
-    # Here we are going to actually save the new file created - the resized SVS file as a PNG file.  This is
-    # a typical image type you could open up on your computer without any special software.  The code here is just
-    # taking the original file name and replacing the '.svs' extension with '.png' and then saving it along side
-    # the SVS version.
-    new_slide_name = os.path.splitext(slide_path)[0] + '.png'
-    img.save(new_slide_name)
-
-    # We will now return the PNG file name, so we could open it up in the next step.  Alternatively the code could
-    # be written to avoid saving and re-opening the file; sending the bytes directly (PIL/NumPy objects).  This would
-    # be a little faster, but the overhead in this program comes mostly from opening the SVS image and resizing it
-    return new_slide_name
+    These are the functions that make up the 'pipeline'
+      1) We need to scale each SVS image to something smaller based on our scale factor.
+      2) Take that output and send it to the Clarifai platform by using the Clarifai Client, in batches.
+         Up to MAX_IN_FLIGHT batches are sent at once, while the following slides are scaled.
+
+    If any of the batches could not be sent, an exception is raised once all of the other batches have finished; the
+    SVS files of those batches are left in place so they can be tried again.
+    """
+    pending = collections.deque()
+    failed_batches = 0
+    try:
+        for inputs, batch_slide_paths in build_batches(slide_paths):
+            pending.append((send_inputs(inputs, metadata), batch_slide_paths))
+
+            # Wait for the oldest batch to finish before starting any more, so there are never more than
+            # MAX_IN_FLIGHT batches (and their images) held in memory at once.
+            if len(pending) >= MAX_IN_FLIGHT and not finish_send(*pending.popleft()):
+                failed_batches += 1
+    finally:
+        # Every batch that was sent is waited on (even if something went wrong along the way), so that the SVS files
+        # of the batches that did succeed are always cleaned up, and will not be sent again if the script is rerun.
+        while pending:
+            if not finish_send(*pending.popleft()):
+                failed_batches += 1
+
+    if failed_batches:
+        raise Exception("Post inputs failed for {} batch(es), see the errors above".format(failed_batches))
 
 
 #
-# Take in the path for the SVS file (slide) along with the key to use to call Clarifai
+# Take in the paths for the SVS files (slides) along with the key to use to call Clarifai
 #
 if __name__ == '__main__':
     # Creating a convenient way to allow for command line arguments
-    parser = argparse.ArgumentParser(description='Process SVS slide.')
-    parser.add_argument('slide_path', help='SVS file path')
-    parser.add_argument('-key', '-k', help='Clarifai.com API key for the App that the images should be posted to.')
+    parser = argparse.ArgumentParser(description='Process SVS slides.')
+    parser.add_argument('slide_paths', nargs='+',
+                        help="SVS file paths, or directories to search for SVS files ('-' reads paths from stdin)")
+    parser.add_argument('-k', '--key', '-key', default=os.environ.get('CLARIFAI_KEY'),
+                        help='Clarifai.com API key for the App that the images should be posted to '
+                             '(defaults to the CLARIFAI_KEY environment variable).')
+    parser.add_argument('-v', '--verbose', action='store_true', help='Log the progress of each slide.')
     args = parser.parse_args()
+    if not args.key:
+        parser.error('a Clarifai.com API key is required (use -k/--key or set CLARIFAI_KEY)')
+
+    # Only this script's own messages are made more verbose by -v, not those of the libraries it uses.
+    logging.basicConfig(level=logging.INFO, format='[ %(levelname)s ] %(message)s')
+    if args.verbose:
+        logger.setLevel(logging.DEBUG)
     
     # Construct the Clarifai API metadata object, based on the instructions in the API documentation
     api_metadata = (('authorization', 'Key {}'.format(args.key)),)
-    
-    # Construct the metadata including the cancer type, and the GDC ID, etc.
-    # This could really include whatever information is relevant to label the
-    # images with.
-    #
-    # In this particular case, we are just taking advantage of the fact that this
-    # information is contained in the paths downloaded, and parsing from there.
-    # A more robust implementation would query the metadata of an item based on
-    # the GDC ID or some other information extracted from the file name.
-    split_vars = args.slide_path.split("/")
-    tcga_full_id = split_vars[3].split(".")[0]
-    tcga = tcga_full_id.split("-")
-
-    sample_metadata = {
-        "general_cancer": split_vars[1],
-        "gdc_id": split_vars[2],
-        "tcga_full_id": tcga_full_id,
-        "tcga_id": tcga[0] + "-" + tcga[1] + "-" + tcga[2]
-    }
-
-    # These are the functions that make up the 'pipeline'
-    #   1) We need to scale the SVS image to something smaller based on our scale factor.
-    #   2) Take that output and send it to the Clarifai platform by using the Clarifai Client
-    new_slide_name = slide_to_scaled_pil_image(args.slide_path, sample_metadata)
-    send_image(new_slide_name, sample_metadata, api_metadata)
-
 
+    main(args.slide_paths, api_metadata)